@@ -4,18 +4,58 @@ Module for collecting historic MLB game data.
 This module contains methods for collecting MLB game data for the pitch/fx era
 in a variety of time frames.
 """
+import asyncio
 import calendar
-import multiprocessing as mp
+import contextlib
+import functools
+import itertools
+import json
 import os
 import re
-import threading
 import time
 
-from bs4 import BeautifulSoup
-import requests
+import aiofiles
+import httpx
+import lxml.html
 from stem import Signal
 from stem.control import Controller
 
+# Shared by every day-page parse; building a parser per call redoes the
+# libxml2 setup for each of the ~30 pages in a month. The event loop is
+# single threaded so reuse is safe.
+_HTML_PARSER = lxml.html.HTMLParser()
+
+_ETAG_INDEX = 'etags.json'
+
+# The inning listing also contains entries like inning_hit.xml and
+# inning_Scores.xml that the archive does not collect; only the
+# numbered per-inning files are wanted.
+_INNING_RE = re.compile(r'inning_\d+\.xml')
+
+# SOCKS ports of the configured TOR exit circuits; spreading requests
+# across them keeps the per-exit request rate low.
+_PROXY_PORTS = [9050] + list(range(9052, 9071))
+
+
+@functools.lru_cache(maxsize=None)
+def season_days(year, month):
+    """
+    List every date in a month as 'YYYY-MM-DD' strings.
+
+    The archive covers a fixed, finite set of months, so the day lists
+    are memoized instead of redoing the calendar arithmetic every time
+    a month is (re)visited.
+
+    Args:
+        year (string): Year in format 'YYYY'.
+        month (string): Month in format 'MM'.
+
+    Returns:
+        days (list): Dates in the format 'YYYY-MM-DD'.
+    """
+    num_days = calendar.monthrange(int(year), int(month))[1]
+    return [f'{year}-{month}-{day:02d}' for day in range(1, num_days + 1)]
+
 
 class GetGames(object):
     """
@@ -29,64 +69,39 @@ class GetGames(object):
 
     def __init__(self):
         """Initialize GetGames object."""
-        self.sessions = []
-        self.setup_sessions()
-        self.setup_proxies()
+        self.sessions = None
         self.year = None
         self.month = None
         self.home = 'http://gd2.mlb.com/components/game/mlb/'
-        self.tasks = mp.Queue()
-        self.inning_tasks = mp.Queue()
-        # self.requests = 0
-
-    def setup_sessions(self):
-        """Setup as many requests Sessions as there are cores available."""
-        for _ in range(mp.cpu_count()):
-            self.sessions.append(requests.Session())
-
-    def setup_proxies(self):
-        """Setup proxies for all sessions."""
-        all_proxies = [9050] + list(range(9052, 9071))
-        for index, session in enumerate(self.sessions):
-            proxy = all_proxies[index]
-            proxies = {
-                'http': 'socks5://127.0.0.1:{}'.format(proxy),
-                'https': 'socks5://127.0.0.1:{}'.format(proxy)
-            }
-            setattr(session, 'proxies', proxies)
+        self.inning_tasks = []
+        self.downloaded = set()
+        self.made_dirs = set()
+        self.limiter = None
+        self.controller = None
+        self.etags = self._load_etags()
 
-    @staticmethod
-    def renew_connection():
-        """Change tor exit node. This will allow cycling of IP addresses."""
-        with Controller.from_port(port=9051) as controller:
-            controller.authenticate(password="password")
-            controller.signal(Signal.NEWNYM)
-
-    # def get_site(self, url, session_num=0):
-    #     """
-    #     Retrieve html from a site using a specific requests.Session object.
-    #
-    #     Args:
-    #         url (string): Website to pull html from.
-    #
-    #     Kwargs:
-    #         session_num (int): Index of self.sessions to use for request.
-    #
-    #     Returns:
-    #         html (string): Html of desired site.
-    #     """
-    #     html = self.sessions[session_num].get(url).text
-    #     # try:
-    #     #     html = self.sessions[session_num].get(url).text
-    #     # except:
-    #     #     self.renew_connection()
-    #     #     html = self.sessions[session_num].get(url).text
-    #     # self.requests += 1
-    #     # print(self.requests, url)
-    #     # if self.requests > 200:
-    #     #     self.requests = 0
-    #     #     self.renew_connection()
-    #     return html
+    def renew_connection(self):
+        """Change tor exit node. This will allow cycling of IP addresses.
+
+        The control-port connection is opened on first use and kept for
+        the life of the object so each renewal only sends the NEWNYM
+        signal instead of re-running the socket handshake and
+        authentication.
+        """
+        if self.controller is None:
+            self.controller = Controller.from_port(port=9051)
+            self.controller.authenticate(password="password")
+        self.controller.signal(Signal.NEWNYM)
+
+    def close(self):
+        """Close the persistent TOR control connection."""
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+
+    def __del__(self):
+        """Make sure the control connection is released on teardown."""
+        self.close()
 
     def get_year(self, year):
         """
@@ -101,14 +116,13 @@ class GetGames(object):
         year = str(year)
         self.year = year
         for month in range(1, 13):
-            month = format(month, '02d')
+            month = f'{month:02d}'
             self.month = month
-            month = year + '-' + month
-            self.get_month(month)
+            self.get_month(f'{year}-{month}')
 
     def get_month(self, month):
         """
-        Collect all game links for a given month.
+        Collect all games for a given month.
 
         Given a month in the format 'YYYY-MM', collect all of the games that
         occurred in that month.
@@ -120,22 +134,53 @@ class GetGames(object):
         if not self.year:
             self.year = date[0]
             self.month = date[1]
-        days = calendar.monthrange(int(self.year), int(self.month))[1]
-        days = [format(day, '02d') for day in range(1, days + 1)]
-        days = ['-'.join(date) + '-' + day for day in days]
-        threads = []
-        for index, day in enumerate(days):
-            index = index % mp.cpu_count()
-            thread = threading.Thread(
-                target=self.get_day,
-                args=(day, index, )
-            )
-            threads.append(thread)
-            thread.start()
-        for thread in threads:
-            thread.join()
+        days = season_days(self.year, self.month)
+        asyncio.run(self._collect_days(days))
+
+    async def _collect_days(self, days):
+        """
+        Fetch the day pages and all games they link to concurrently.
 
-    def get_day(self, date, session_num):
+        One HTTP/2 client is kept per TOR exit port and requests are
+        dealt to them round robin, so traffic stays spread across the
+        configured circuits while each client's keep-alive pool is
+        reused for day pages, games and inning fallbacks alike. Game
+        downloads start as soon as their day page has been parsed, so
+        link discovery overlaps fetching instead of running as a
+        separate phase.
+
+        Args:
+            days (list): Dates in the format 'YYYY-MM-DD'.
+        """
+        self.downloaded = self._existing_games(self.year, self.month)
+        self.limiter = asyncio.Semaphore(64)
+        limits = httpx.Limits(max_connections=8,
+                              max_keepalive_connections=4)
+        # The gd2 XML compresses better than 10:1, so ask for brotli
+        # ahead of gzip; aiter_bytes hands back decoded bytes either way.
+        headers = {'Accept-Encoding': 'br, gzip, deflate'}
+        async with contextlib.AsyncExitStack() as stack:
+            sessions = [
+                await stack.enter_async_context(httpx.AsyncClient(
+                    http2=True, limits=limits, headers=headers,
+                    proxy=f'socks5://127.0.0.1:{port}'))
+                for port in _PROXY_PORTS
+            ]
+            self.sessions = itertools.cycle(sessions)
+            game_tasks = []
+            for day in asyncio.as_completed(
+                    [self.get_day(day) for day in days]):
+                games = await day
+                game_tasks.extend(
+                    asyncio.create_task(self._get_game(url)) for url in games)
+            await asyncio.gather(*game_tasks)
+            await asyncio.gather(
+                *[self._get_inning(url) for url in self.inning_tasks])
+            self.inning_tasks = []
+        self.sessions = None
+        self._save_etags()
+
+    async def get_day(self, date):
         """
         Collect all games from a given day.
 
@@ -144,132 +189,145 @@ class GetGames(object):
 
         Args:
             date (string): Date in the format 'YYYY-MM-DD' (ISO 8601 format).
-            session_num (int): Integer representing the session number to use
-                for making requests.
+
+        Returns:
+            games (list): Urls of the day's games not yet downloaded.
         """
-        session = self.sessions[session_num]
         date = date.split('-')
         if not self.month:
             self.year = date[0]
             self.month = date[1]
         day = date[2]
-        url = self.home + 'year_{}/month_{}/day_{}/'.format(
-            self.year, self.month, day
-        )
-        day_page = session.get(url)
-        day_soup = BeautifulSoup(day_page.text, 'html.parser')
-        games = day_soup.find_all('a', text=re.compile('gid\w*/'))
-        games = [url + game['href'] for game in games]
-        for game in games:
-            if os.path.exists('/'.join(game.split('/')[-5:])):
-                continue
-            self.tasks.put(game)
+        url = f'{self.home}year_{self.year}/month_{self.month}/day_{day}/'
+        day_page = await next(self.sessions).get(url)
+        day_tree = lxml.html.fromstring(day_page.content, parser=_HTML_PARSER)
+        hrefs = day_tree.xpath("//a[starts-with(@href, 'gid')]/@href")
+        return [url + href for href in hrefs
+                if href.strip('/') not in self.downloaded]
 
-    def _get_game(self, session_num):
+    @staticmethod
+    def _load_etags():
+        """Load the url -> etag index from disk, empty if absent."""
+        if not os.path.exists(_ETAG_INDEX):
+            return {}
+        with open(_ETAG_INDEX) as index_obj:
+            return json.load(index_obj)
+
+    def _save_etags(self):
+        """Persist the url -> etag index for the next run."""
+        with open(_ETAG_INDEX, 'w') as index_obj:
+            json.dump(self.etags, index_obj)
+
+    @staticmethod
+    def _existing_games(year, month):
         """
-        Retrieve game_url from queue and retrieve its data.
+        Collect the game ids already downloaded for a given month.
+
+        One directory walk replaces a stat() syscall per game when a
+        month is re-run; get_day then tests set membership instead.
 
         Args:
-            session_num (int): Integer representing the session number to use
-                for making requests.
+            year (string): Year in format 'YYYY'.
+            month (string): Month in format 'MM'.
+
+        Returns:
+            games (set): Game id directory names already on disk.
         """
-        while True:
-            game_url = self.tasks.get()
-            if not game_url:
-                break
-            session = self.sessions[session_num]
-            players = session.get(game_url + 'players.xml')
-            players = BeautifulSoup(players, 'lxml')
-            innings = session.get(game_url + 'inning/inning_all.xml')
-            innings = BeautifulSoup(innings, 'lxml')
-            if 'Not Found' in innings.find('p').text:
-                self._queue_innings(game_url + 'inning/', session)
-            directory = '/'.join(game_url.split('/')[6:])
-            os.makedirs(directory, mode=0o777, exist_ok=True)
-            with open(directory + '/players.xml', 'w') as players_obj:
-                players_obj.write(players.prettify())
-            with open(directory + '/inning_all.xml', 'w') as innings_obj:
-                innings_obj.write(innings.prettify())
-
-    def _get_inning(self, session_num):
+        games = set()
+        month_dir = f'year_{year}/month_{month}'
+        if not os.path.isdir(month_dir):
+            return games
+        for day in os.scandir(month_dir):
+            if not day.is_dir():
+                continue
+            games.update(
+                game.name for game in os.scandir(day) if game.is_dir())
+        return games
+
+    async def _download(self, url, filename):
         """
-        Given an inning url retrieve the data for that inning.
+        Stream the body of url straight to filename.
+
+        The response is consumed in chunks so a multi-megabyte
+        inning_all.xml never has to sit in memory as one string. When a
+        copy already exists on disk its recorded etag is sent as
+        If-None-Match; finished seasons never change, so a re-run gets
+        a bodiless 304 back and keeps the existing file. A missing file
+        is always fetched in full, even if an etag is known.
 
         Args:
-            session_num (int): Integer representing the session number to use
-                for making requests.
-        """
-        while True:
-            inning_url = self.inning_tasks.get()
-            if not inning_url:
-                break
-            session = self.sessions[session_num]
-            inning = session.get(inning_url)
-            inning = BeautifulSoup(inning, 'lxml')
-            filename = '/'.join(inning_url.split('/')[6:])
-            with open(filename, 'w') as inning_obj:
-                inning_obj.write(inning.prettify())
-
-    def _queue_innings(self, game_url, session):
+            url (string): Address of the file to download.
+            filename (string): Path the body should be written to.
+
+        Returns:
+            status (int): HTTP status code of the response.
         """
-        Given a game_url retrieve the links for the individual innings.
+        headers = {}
+        if url in self.etags and os.path.exists(filename):
+            headers['If-None-Match'] = self.etags[url]
+        session = next(self.sessions)
+        async with session.stream('GET', url, headers=headers) as resp:
+            if resp.status_code != 200:
+                return resp.status_code
+            directory = os.path.dirname(filename)
+            if directory not in self.made_dirs:
+                os.makedirs(directory, mode=0o777, exist_ok=True)
+                self.made_dirs.add(directory)
+            async with aiofiles.open(filename, 'wb') as file_obj:
+                async for chunk in resp.aiter_bytes():
+                    await file_obj.write(chunk)
+            etag = resp.headers.get('etag')
+            if etag:
+                self.etags[url] = etag
+        return resp.status_code
 
-        Collect all of the individual inning links for a given game and place
-        them into a queue for use with multiprocessing.
+    async def _get_game(self, game_url):
+        """
+        Retrieve the player and inning data for a single game.
 
         Args:
             game_url (string): String address for an individual game.
-            session (requets.sessions.Session): Tor session for retrieving game
-                anonymously.
         """
-        innings = session.get(game_url)
-        soup = BeautifulSoup(innings.text, 'html.parser')
-        innings = soup.find('a', text=re.compile('inning_\d+.xml'))
-        for inning in innings:
-            self.inning_tasks.put(inning.text)
-
-    # def get_games_concurrent(self, games):
-    #     threads = []
-    #     for index, game in enumerate(games):
-    #         index = index % 8
-    #         thread = threading.Thread(
-    #             target=self.get_game,
-    #             args=(game, index, )
-    #         )
-    #         threads.append(thread)
-    #         thread.start()
-    #     for thread in threads:
-    #         thread.join()
+        directory = '/'.join(game_url.split('/')[6:])
+        async with self.limiter:
+            _, innings_status = await asyncio.gather(
+                self._download(game_url + 'players.xml',
+                               directory + '/players.xml'),
+                self._download(game_url + 'inning/inning_all.xml',
+                               directory + '/inning_all.xml')
+            )
+        if innings_status == 404:
+            await self._queue_innings(game_url + 'inning/')
 
-    @staticmethod
-    def _empty_queue(queue, func):
+    async def _get_inning(self, inning_url):
+        """
+        Given an inning url retrieve the data for that inning.
+
+        Args:
+            inning_url (string): String address for an individual inning.
+        """
+        filename = '/'.join(inning_url.split('/')[6:])
+        async with self.limiter:
+            await self._download(inning_url, filename)
+
+    async def _queue_innings(self, game_url):
         """
-        Retrieve data for all games in self.Tasks.
+        Given a game_url retrieve the links for the individual innings.
 
-        Using all available processes, retrieve and store inning and player
-        data for all games in the tasks Queue.
+        Collect all of the individual inning links for a given game so they
+        can be fetched alongside the remaining games.
 
         Args:
-            queue (multiprocessing.queues.Queue): Queue holding objects to be
-                processed. Either games or innings.
-            func (function): Function to be used to process queue
+            game_url (string): String address for an individual game.
         """
-        for _ in range(mp.cpu_count()):
-            queue.put(None)
-        workers = []
-        for _ in range(mp.cpu_count()):
-            worker = mp.Process(target=func, args=(_,))
-            workers.append(worker)
-            worker.start()
-        for worker in workers:
-            worker.join()
-        for worker in workers:
-            worker.terminate()
+        innings = await next(self.sessions).get(game_url)
+        tree = lxml.html.fromstring(innings.content, parser=_HTML_PARSER)
+        hrefs = tree.xpath("//a[starts-with(@href, 'inning_')]/@href")
+        self.inning_tasks.extend(
+            game_url + href for href in hrefs if _INNING_RE.fullmatch(href))
 
     def get_all_years(self):
         """Retrieve data for all games beginning in 2007."""
-        curr_year = int(time.strftime('%Y', tuple=None))
+        curr_year = int(time.strftime('%Y'))
         for year in range(2007, curr_year + 1):
             self.get_year(str(year))
-            self._empty_queue(self.tasks, self._get_game)
-            self._empty_queue(self.inning_tasks, self._get_inning)